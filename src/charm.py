@@ -3,11 +3,10 @@
 import logging
 
 from infiniband_ops_manager import (
+    RESOURCE_NAME,
     InfinibandOpsError,
-    InfinibandOpsManagerCentos,
-    InfinibandOpsManagerUbuntu,
+    InfinibandOpsManager,
     needs_reboot,
-    os_release,
 )
 from ops.charm import CharmBase
 from ops.framework import StoredState
@@ -16,6 +15,19 @@ from ops.model import ActiveStatus, BlockedStatus, ModelError, WaitingStatus
 
 logger = logging.getLogger()
 
+_IB_MODULES = (
+    "rdma_ucm",
+    "rdma_cm",
+    "ib_ipoib",
+    "mlx5_core",
+    "mlx5_ib",
+    "ib_uverbs",
+    "ib_umad",
+    "ib_cm",
+    "ib_core",
+    "mlxfw",
+)
+
 
 class InfinibandOperator(CharmBase):
     """Infiniband Charmed Operator."""
@@ -30,22 +42,14 @@ class InfinibandOperator(CharmBase):
             infiniband_installed=False,
         )
 
-        if os_release()["ID"] == "ubuntu":
-            self.resource_name = "apt-repo"
-            self._infiniband_ops_manager = InfinibandOpsManagerUbuntu()
-        else:
-            self.resource_name = "yum-repo"
-            self._infiniband_ops_manager = InfinibandOpsManagerCentos()
-
-        event_handler_bindings = {
-            self.on.install: self._on_install,
-            self.on.remove: self._on_remove,
-            self.on.update_status: self._on_update_status,
-            self.on.modprobe_action: self.modprobe_action,
-            self.on.ibstatus_action: self.ibstatus_action,
-        }
-        for event, handler in event_handler_bindings.items():
-            self.framework.observe(event, handler)
+        self.resource_name = RESOURCE_NAME
+        self._infiniband_ops_manager = InfinibandOpsManager()
+
+        self.framework.observe(self.on.install, self._on_install)
+        self.framework.observe(self.on.remove, self._on_remove)
+        self.framework.observe(self.on.update_status, self._on_update_status)
+        self.framework.observe(self.on.modprobe_action, self.modprobe_action)
+        self.framework.observe(self.on.ibstatus_action, self.ibstatus_action)
 
     def _on_install(self, event):
         """Install Infiniband drivers."""
@@ -98,29 +102,16 @@ class InfinibandOperator(CharmBase):
 
     def modprobe_action(self, event):
         """Modprobe the Infiniband modules."""
-        modules = [
-            "rdma_ucm",
-            "rdma_cm",
-            "ib_ipoib",
-            "mlx5_core",
-            "mlx5_ib",
-            "ib_uverbs",
-            "ib_umad",
-            "ib_cm",
-            "ib_core",
-            "mlxfw",
-        ]
-
         msg = "Modprobing InfiniBand modules..."
         logger.info(msg)
         self.unit.status = WaitingStatus(msg)
 
         try:
-            self._infiniband_ops_manager.modprobe(modules)
+            self._infiniband_ops_manager.modprobe(_IB_MODULES)
         except InfinibandOpsError as e:
             logger.error(e)
             self.unit.status = BlockedStatus(e)
-            event.defer()
+            event.fail(str(e))
             return
 
         self.unit.status = ActiveStatus("Ready")
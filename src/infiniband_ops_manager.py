@@ -1,40 +1,78 @@
 #!/usr/bin/env python3
 """InfiniBand install, remove and return version."""
+import functools
 import logging
+import os
+import re
 import tempfile
 from pathlib import Path
-from subprocess import CalledProcessError, check_output, run
+from subprocess import PIPE, CalledProcessError, TimeoutExpired, check_output, run
+from typing import Sequence
 
 import requests
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger()
 
+# (connect, read) timeouts for downloads, and a cap on apt-get update/yum clean.
+# Package install and removal runs are deliberately unbounded: they build the
+# OFED kernel modules, and killing apt-get/yum would orphan dpkg/rpm holding the lock.
+_DOWNLOAD_TIMEOUT = (5, 30)
+_REPO_REFRESH_TIMEOUT = 600
 
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+_SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+
+
+def _download(url: str, path: Path, expected_header: bytes = b"") -> None:
+    """Stream the contents of url to path, replacing path only once complete.
+
+    Raise ValueError, leaving path untouched, if the body does not start with
+    expected_header.
+    """
+    with _SESSION.get(url, stream=True, timeout=_DOWNLOAD_TIMEOUT) as response:
+        response.raise_for_status()
+        # write next to the target so the final rename is atomic
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+        try:
+            head = b""
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(chunk_size=65536):
+                    if len(head) < len(expected_header):
+                        head += chunk
+                    f.write(chunk)
+            if not head.startswith(expected_header):
+                raise ValueError(f"Unexpected content downloaded from {url}")
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+@functools.lru_cache(maxsize=None)
 def os_release():
     """Return /etc/os-release as a dict."""
-    os_release_data = Path("/etc/os-release").read_text()
-    os_release_list = [
-        item.split("=") for item in os_release_data.strip().split("\n") if item != ""
-    ]
-    return {k: v.strip('"') for k, v in os_release_list}
+    result = {}
+    for line in Path("/etc/os-release").read_text().splitlines():
+        if not line or line.startswith("#"):
+            continue
+        key, _, value = line.partition("=")
+        result[key] = value.strip('"')
+    return result
 
 
+@functools.lru_cache(maxsize=None)
 def arch() -> str:
     """Return the system architecture."""
-    try:
-        arch = check_output(["/bin/arch"])
-    except CalledProcessError:
-        raise InfinibandOpsError("Error detecting system architecture.")
-    return arch.decode().strip()
+    return os.uname().machine
 
 
+@functools.lru_cache(maxsize=None)
 def uname_r() -> str:
     """Return the kernel version."""
-    try:
-        kernel_version = check_output(["/usr/bin/uname", "-r"])
-    except CalledProcessError:
-        raise InfinibandOpsError("Error detecting kernel version.")
-    return kernel_version.decode().strip()
+    return os.uname().release
 
 
 def needs_reboot() -> bool:
@@ -57,6 +95,7 @@ class InfinibandOpsManagerBase:
 
     def __init__(self):
         self._driver_package = "mlnx-ofed-all"
+        self._version = None
 
     def install(self) -> None:
         """Install Infiniband driver here."""
@@ -68,21 +107,33 @@ class InfinibandOpsManagerBase:
 
     def version(self) -> str:
         """Return the version of the InfiniBand driver."""
+        if self._version is not None:
+            return self._version
+
         # get the version from ofed_info
         try:
             version = check_output(["ofed_info", "-s"])
         except CalledProcessError:
             raise InfinibandOpsError("Cannot return version for package that isn't installed.")
 
-        return version.decode().strip("MLNX_OFED_LINUX-:\n")
+        # ofed_info -s prints e.g. "MLNX_OFED_LINUX-5.8-1.1.2.1:"
+        version = version.decode().strip()
+        prefix = "MLNX_OFED_LINUX-"
+        if version.startswith(prefix):
+            version = version[len(prefix) :]
+        self._version = version.rstrip(":")
+        return self._version
 
-    def modprobe(self, modules: list) -> None:
+    def modprobe(self, modules: Sequence[str]) -> None:
         """Modprobe the Infiniband modules."""
-        for module in modules:
-            try:
-                run(["modprobe", module])
-            except CalledProcessError:
-                raise InfinibandOpsError(f"Error modprobing {module}")
+        try:
+            run(["modprobe", "-a", *modules], stderr=PIPE, universal_newlines=True, check=True)
+        except CalledProcessError as e:
+            logger.error(f"modprobe failed: {e.stderr}")
+            # modprobe reports every module it could not load on stderr
+            words = set(re.findall(r"[\w-]+", e.stderr or ""))
+            failed = [module for module in modules if module in words] or modules
+            raise InfinibandOpsError(f"Error modprobing {', '.join(failed)}")
 
     def ibstatus(self) -> str:
         """Show InfiniBand status."""
@@ -101,6 +152,7 @@ class InfinibandOpsManagerUbuntu(InfinibandOpsManagerBase):
     def __init__(self):
         super().__init__()
         self._driver_repo_filepath = Path("/etc/apt/sources.list.d/infiniband.list")
+        self._driver_key_filepath = Path("/etc/apt/trusted.gpg.d/mellanox.asc")
 
     def _set_repository(self, repo_path: Path) -> None:
         """Set a custom repository to install Infiniband drivers."""
@@ -119,65 +171,66 @@ class InfinibandOpsManagerUbuntu(InfinibandOpsManagerBase):
         # GPG key url
         key_url = "http://www.mellanox.com/downloads/ofed/RPM-GPG-KEY-Mellanox"
 
-        # download the GPG key on tmp file
-        with tempfile.TemporaryDirectory() as tmpdir:
-            tmp_key_path = Path(f"{tmpdir}/mellanox.gpg")
-
-            try:
-                key_req = requests.get(key_url)
-            except requests.exceptions.HTTPError:
-                raise InfinibandOpsError(f"Error getting InfiniBand GPG key {key_url}")
-
-            tmp_key_path.write_text(key_req.text)
-
-            try:
-                run(["apt-key", "add", str(tmp_key_path)])
-            except CalledProcessError:
-                raise InfinibandOpsError("Failed to add InfiniBand GPG key")
+        # download the armored GPG key straight into apt's trusted keyring dir
+        try:
+            _download(
+                key_url,
+                self._driver_key_filepath,
+                expected_header=b"-----BEGIN PGP PUBLIC KEY BLOCK-----",
+            )
+        except requests.exceptions.RequestException:
+            raise InfinibandOpsError(f"Error getting InfiniBand GPG key {key_url}")
+        except ValueError:
+            raise InfinibandOpsError("Failed to add InfiniBand GPG key")
 
         logger.info("InfiniBand repository configured")
 
     def install(self, repo_path: Path) -> None:
         """Install InfiniBand drivers on Ubuntu."""
+        # the installed driver version is about to change
+        self._version = None
+
         # set the apt repository
         self._set_repository(repo_path)
 
         # update repositories
         try:
-            run(["apt-get", "update"])
-        except CalledProcessError:
+            run(["apt-get", "update"], check=True, timeout=_REPO_REFRESH_TIMEOUT)
+        except (CalledProcessError, TimeoutExpired):
             raise InfinibandOpsError("Error running `apt-get update`")
 
-        # install the kernel headers
+        # install the kernel headers and the InfiniBand drivers
         uname = uname_r()
         try:
-            run(["apt-get", "install", "-y", f"linux-headers-{uname}"])
-        except CalledProcessError:
-            raise InfinibandOpsError("Error installing kernel headers")
-
-        # install the InfiniBand drivers
-        try:
-            run(["apt-get", "install", "-y", self._driver_package])
+            run(
+                ["apt-get", "install", "-y", f"linux-headers-{uname}", self._driver_package],
+                check=True,
+            )
         except CalledProcessError:
-            raise InfinibandOpsError("Error installing InfiniBand drivers")
+            raise InfinibandOpsError("Error installing kernel headers and InfiniBand drivers")
 
         # request a system reboot
         Path("/var/run/reboot-required").touch()
 
     def remove(self) -> None:
         """Remove InfiniBand drivers from the OS."""
+        # the installed driver version is about to change
+        self._version = None
+
         try:
-            run(["apt-get", "-y", "remove", "--purge", self._driver_package])
+            run(["apt-get", "-y", "remove", "--purge", self._driver_package], check=True)
         except CalledProcessError:
             raise InfinibandOpsError("Error removing InfiniBand drivers")
 
-        # Remove the drivers repo
+        # Remove the drivers repo and its GPG key
         if self._driver_repo_filepath.exists():
             self._driver_repo_filepath.unlink()
+        if self._driver_key_filepath.exists():
+            self._driver_key_filepath.unlink()
 
         try:
-            run(["apt-get", "update"])
-        except CalledProcessError:
+            run(["apt-get", "update"], check=True, timeout=_REPO_REFRESH_TIMEOUT)
+        except (CalledProcessError, TimeoutExpired):
             raise InfinibandOpsError("Error running `apt-get update`")
 
 
@@ -204,27 +257,30 @@ class InfinibandOpsManagerCentos(InfinibandOpsManagerBase):
             # download driver version 5.8-1.1.2.1 repo as default
             repo_url = "http://linux.mellanox.com/public/repo/mlnx_ofed/5.8-1.1.2.1/rhel7.9/mellanox_mlnx_ofed.repo"
             try:
-                req = requests.get(repo_url)
-            except requests.exceptions.HTTPError:
+                _download(repo_url, self._driver_repo_filepath)
+            except requests.exceptions.RequestException:
                 raise InfinibandOpsError(f"Error getting InfiniBand repository from {repo_url}")
 
-            self._driver_repo_filepath.write_text(req.text)
-
         logger.info("InfiniBand yum repository configured")
 
     def install(self, repo_path: Path) -> None:
         """Install Mellanox Infiniband drivers."""
+        # the installed driver version is about to change
+        self._version = None
+
         # set the yum repository
         self._set_repository(repo_path)
 
         # Expire the cache and update repos
         try:
-            run(["yum", "clean", "expire-cache"])
-        except CalledProcessError:
+            run(["yum", "clean", "expire-cache"], check=True, timeout=_REPO_REFRESH_TIMEOUT)
+        except (CalledProcessError, TimeoutExpired):
             raise InfinibandOpsError("Error flushing the cache")
 
-        # Add the devel kernel and kernel headers
-        logger.info("Installing kernel devel and headers")
+        # Add the devel kernel, kernel headers and infiniband driver
+        logger.info(
+            f"Installing kernel devel, headers and InfiniBand {self._driver_package} drivers"
+        )
 
         uname = uname_r()
 
@@ -236,26 +292,26 @@ class InfinibandOpsManagerCentos(InfinibandOpsManagerBase):
                     "-y",
                     f"kernel-devel-{uname}",
                     f"kernel-headers-{uname}",
-                ]
+                    self._driver_package,
+                ],
+                check=True,
             )
         except CalledProcessError:
-            raise InfinibandOpsError("Error installing devel kernel headers")
-
-        # Install infiniband driver
-        logger.info(f"Installing InfiniBand {self._driver_package} drivers")
-        try:
-            run(["yum", "install", "-y", self._driver_package])
-        except CalledProcessError:
-            raise InfinibandOpsError(f"Error installing InfiniBand {self._driver_package} drivers")
+            raise InfinibandOpsError(
+                f"Error installing kernel devel, headers and InfiniBand {self._driver_package} drivers"
+            )
 
         # request a system reboot
         Path("/var/run/reboot-required").touch()
 
     def remove(self) -> None:
         """Remove Infiniband drivers from the system."""
+        # the installed driver version is about to change
+        self._version = None
+
         # Remove infiniband driver package
         try:
-            run(["yum", "erase", "-y", self._driver_package])
+            run(["yum", "erase", "-y", self._driver_package], check=True)
         except CalledProcessError:
             raise InfinibandOpsError("Error removing InfiniBand drivers from the system")
 
@@ -265,6 +321,15 @@ class InfinibandOpsManagerCentos(InfinibandOpsManagerBase):
 
         # Expire the cache and update repos
         try:
-            run(["yum", "clean", "expire-cache"])
-        except CalledProcessError:
+            run(["yum", "clean", "expire-cache"], check=True, timeout=_REPO_REFRESH_TIMEOUT)
+        except (CalledProcessError, TimeoutExpired):
             raise InfinibandOpsError("Error flushing the cache")
+
+
+# Resolve the distro-specific manager and repo resource once, at import time.
+if os_release()["ID"] == "ubuntu":
+    InfinibandOpsManager = InfinibandOpsManagerUbuntu
+    RESOURCE_NAME = "apt-repo"
+else:
+    InfinibandOpsManager = InfinibandOpsManagerCentos
+    RESOURCE_NAME = "yum-repo"
@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
+import tempfile
 import unittest
+from pathlib import Path
+from subprocess import CalledProcessError, TimeoutExpired
+from unittest.mock import Mock, patch
 
+import requests
 from charm import InfinibandOperator
+from infiniband_ops_manager import InfinibandOpsError, InfinibandOpsManagerUbuntu, _download
 from ops.testing import Harness
 
 
@@ -17,3 +23,98 @@ class TestCharm(unittest.TestCase):
     def test_pass(self) -> None:
         """Test pass."""
         pass
+
+    @patch("infiniband_ops_manager.check_output")
+    def test_version(self, check_output) -> None:
+        """Test that the driver version is parsed once and memoized."""
+        check_output.return_value = b"MLNX_OFED_LINUX-5.8-1.1.2.1-LTX:\n"
+        manager = self.harness.charm._infiniband_ops_manager
+        self.assertEqual(manager.version(), "5.8-1.1.2.1-LTX")
+        self.assertEqual(manager.version(), "5.8-1.1.2.1-LTX")
+        check_output.assert_called_once()
+
+    @patch("infiniband_ops_manager.run")
+    def test_modprobe_action_fail(self, run) -> None:
+        """Test that a failed modprobe fails the action with the offending module."""
+        run.side_effect = CalledProcessError(
+            1, "modprobe", stderr="modprobe: FATAL: Module mlxfw not found in directory\n"
+        )
+        event = Mock()
+        self.harness.charm.modprobe_action(event)
+        event.fail.assert_called_once_with("Error modprobing mlxfw")
+        event.defer.assert_not_called()
+
+    @patch("infiniband_ops_manager._SESSION")
+    def test_download_interrupted(self, session) -> None:
+        """Test that an interrupted download raises and leaves the target untouched."""
+
+        def body(chunk_size):
+            yield b"partial"
+            raise requests.exceptions.ConnectionError("Read timed out.")
+
+        response = session.get.return_value.__enter__.return_value
+        response.iter_content.side_effect = body
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            target = Path(tmpdir) / "infiniband.repo"
+            target.write_text("previous")
+            with self.assertRaises(requests.exceptions.RequestException):
+                _download("http://example.com/infiniband.repo", target)
+            self.assertEqual(target.read_text(), "previous")
+            self.assertEqual(list(Path(tmpdir).iterdir()), [target])
+
+    @patch("infiniband_ops_manager._SESSION")
+    def test_gpg_key_download_interrupted(self, session) -> None:
+        """Test that a failed GPG key download leaves no keyring file for apt."""
+        session.get.return_value.__enter__.return_value.iter_content.side_effect = (
+            requests.exceptions.ConnectionError("Read timed out.")
+        )
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            keyring_dir = Path(tmpdir) / "trusted.gpg.d"
+            keyring_dir.mkdir()
+            repo_path = Path(tmpdir) / "infiniband.list"
+            repo_path.touch()
+
+            manager = InfinibandOpsManagerUbuntu()
+            manager._driver_repo_filepath = Path(tmpdir) / "sources.list"
+            manager._driver_key_filepath = keyring_dir / "mellanox.asc"
+            with self.assertRaises(InfinibandOpsError):
+                manager._set_repository(repo_path)
+            self.assertEqual(list(keyring_dir.iterdir()), [])
+
+    @patch("infiniband_ops_manager._SESSION")
+    def test_gpg_key_download_not_a_key(self, session) -> None:
+        """Test that only an armored public key is installed into the keyring."""
+        response = session.get.return_value.__enter__.return_value
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            keyring_dir = Path(tmpdir) / "trusted.gpg.d"
+            keyring_dir.mkdir()
+            manager = InfinibandOpsManagerUbuntu()
+            manager._driver_repo_filepath = Path(tmpdir) / "sources.list"
+            manager._driver_key_filepath = keyring_dir / "mellanox.asc"
+
+            response.iter_content.return_value = [b"<html>captive portal</html>"]
+            repo_path = Path(tmpdir) / "infiniband.list"
+            repo_path.touch()
+            with self.assertRaisesRegex(InfinibandOpsError, "Failed to add InfiniBand GPG key"):
+                manager._set_repository(repo_path)
+            self.assertEqual(list(keyring_dir.iterdir()), [])
+
+            key = b"-----BEGIN PGP PUBLIC KEY BLOCK-----\n\nmQENBF...\n"
+            response.iter_content.return_value = [key[:10], key[10:]]
+            repo_path.touch()
+            manager._set_repository(repo_path)
+            self.assertEqual(manager._driver_key_filepath.read_bytes(), key)
+
+    @patch("infiniband_ops_manager.run")
+    def test_install_apt_update_timeout(self, run) -> None:
+        """Test that a hung apt-get update raises InfinibandOpsError."""
+        run.side_effect = TimeoutExpired(["apt-get", "update"], 600)
+        manager = InfinibandOpsManagerUbuntu()
+
+        with patch.object(manager, "_set_repository"):
+            with self.assertRaisesRegex(InfinibandOpsError, "Error running `apt-get update`"):
+                manager.install(None)
+        run.assert_called_once_with(["apt-get", "update"], check=True, timeout=600)